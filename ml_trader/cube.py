@@ -0,0 +1,272 @@
+import json
+import os
+import shutil
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from ml_trader.utils import save_json
+
+# Default DAILY fields stored in the cube
+CUBE_FIELDS = ["close", "marketcap", "pe", "pb", "ps", "ev", "evebit", "evebitda"]
+
+CUBE_DTYPE = np.float32
+MIN_DAYS_RESERVE = 256  # Min count of empty days preallocated for appends
+
+_META_FILE = 'meta.json'
+_DATES_FILE = 'dates.npy'
+_MASK_FILE = 'mask.npy'
+
+DateLike = Union[str, np.datetime64, pd.Timestamp]
+
+
+def _field_file(field: str) -> str:
+    return f'{field}.npy'
+
+
+def _to_day(date: DateLike) -> np.datetime64:
+    return np.datetime64(pd.Timestamp(date), 'D')
+
+
+def _df_days(df: pd.DataFrame) -> np.ndarray:
+    return pd.to_datetime(df['date']).values.astype('datetime64[D]')
+
+
+class DailyCube:
+    """
+    Dense tickers x trading days view of the Quandl DAILY dataset.
+
+    Every field is a float32 array stored as memory-mapped .npy file in base_path.
+    Days are sorted from old to new (unlike data frames, which are from new to old).
+    The mask is True where the ticker has a DAILY row for the day.
+    Pickling sends only base_path, so workers reopen the same files without copying data.
+    """
+
+    def __init__(self, base_path: str, mode: str = 'r'):
+        assert mode in ('r', 'r+')
+        self.base_path = base_path
+        self.mode = mode
+
+        with open(os.path.join(base_path, _META_FILE), "r") as f:
+            meta = json.load(f)
+
+        self.tickers: List[str] = meta['tickers']
+        self.fields: List[str] = meta['fields']
+        self.days_cnt: int = meta['days_cnt']
+        self.ticker_index: Dict[str, int] = {t: i for i, t in enumerate(self.tickers)}
+
+        self._dates = np.load(os.path.join(base_path, _DATES_FILE), mmap_mode=mode)
+        self._mask = np.load(os.path.join(base_path, _MASK_FILE), mmap_mode=mode)
+        self._data = {
+            field: np.load(os.path.join(base_path, _field_file(field)), mmap_mode=mode)
+            for field in self.fields
+        }
+
+    def __reduce__(self):
+        return self.__class__, (self.base_path, self.mode)
+
+    @property
+    def capacity(self) -> int:
+        return len(self._dates)
+
+    @property
+    def dates(self) -> np.ndarray:
+        return self._dates[:self.days_cnt]
+
+    def date_loc(self, date: DateLike) -> int:
+        """Position of the first trading day >= date"""
+        return int(np.searchsorted(self.dates, _to_day(date), side='left'))
+
+    def _ticker_locs(self, tickers: Optional[Union[str, List[str]]]) -> Union[int, slice, List[int]]:
+        if tickers is None:
+            return slice(None)
+        if isinstance(tickers, str):
+            return self.ticker_index[tickers]
+        return [self.ticker_index[t] for t in tickers]
+
+    def _date_locs(self, start: Optional[DateLike], end: Optional[DateLike]) -> slice:
+        start_loc = 0 if start is None else self.date_loc(start)
+        end_loc = self.days_cnt if end is None else self.date_loc(end)
+        return slice(start_loc, end_loc)
+
+    def get(
+            self,
+            field: str,
+            tickers: Optional[Union[str, List[str]]] = None,
+            start: Optional[DateLike] = None,
+            end: Optional[DateLike] = None,
+    ) -> np.ndarray:
+        """
+        Values of field for start <= date < end (same as df['date'] < curr_date in features).
+        A single ticker or all tickers give a zero-copy view, a list of tickers gives a copy.
+        """
+        return self._data[field][self._ticker_locs(tickers), self._date_locs(start, end)]
+
+    def get_mask(
+            self,
+            tickers: Optional[Union[str, List[str]]] = None,
+            start: Optional[DateLike] = None,
+            end: Optional[DateLike] = None,
+    ) -> np.ndarray:
+        return self._mask[self._ticker_locs(tickers), self._date_locs(start, end)]
+
+    def ticker_df(self, ticker: str, fields: Optional[List[str]] = None) -> pd.DataFrame:
+        """Days with data of ticker sorted from new to old, like rows of quandl_daily_to_df"""
+        fields = fields or self.fields
+        mask = self.get_mask(ticker) if ticker in self.ticker_index else np.zeros(self.days_cnt, dtype=bool)
+
+        df = pd.DataFrame({'date': self.dates[mask][::-1].astype('datetime64[ns]')})
+        df.insert(0, 'ticker', ticker)
+        for field in fields:
+            values = self.get(field, ticker)[mask] if ticker in self.ticker_index else []
+            df[field] = np.asarray(values, dtype=CUBE_DTYPE)[::-1]
+        return df
+
+    def append_days(self, df_daily: pd.DataFrame) -> None:
+        """
+        Write df_daily rows into the cube in place.
+        Dates up to the last stored day overwrite existing cells, new dates are appended.
+        New tickers are appended to the ticker index.
+        The files grow (with reserve) only when the preallocated days are used up or tickers are added.
+        """
+        assert self.mode == 'r+', 'Open cube with mode="r+" to append days'
+        if not len(df_daily):
+            return
+
+        days = _df_days(df_daily)
+        stored_dates = self.dates
+        new_dates = np.unique(days[~np.isin(days, stored_dates)])
+        if len(new_dates) and self.days_cnt and new_dates[0] <= stored_dates[-1]:
+            raise ValueError(f'Can not insert {new_dates[0]} before last cube date {stored_dates[-1]}')
+
+        new_tickers = sorted(set(df_daily['ticker']).difference(self.ticker_index))
+        if new_tickers:
+            print(f'Add {len(new_tickers)} new tickers')
+            self.tickers = self.tickers + new_tickers
+            self.ticker_index = {t: i for i, t in enumerate(self.tickers)}
+
+        new_days_cnt = self.days_cnt + len(new_dates)
+        if new_tickers or new_days_cnt > self.capacity:
+            self._grow(new_days_cnt)
+
+        self._dates[self.days_cnt:new_days_cnt] = new_dates
+        self.days_cnt = new_days_cnt
+        self._write(df_daily, days)
+        self._save_meta()
+
+    def flush(self) -> None:
+        self._dates.flush()
+        self._mask.flush()
+        for arr in self._data.values():
+            arr.flush()
+
+    def _write(self, df_daily: pd.DataFrame, days: np.ndarray) -> None:
+        ticker_locs = df_daily['ticker'].map(self.ticker_index).values
+        date_locs = np.searchsorted(self.dates, days)
+
+        self._mask[ticker_locs, date_locs] = True
+        for field in self.fields:
+            self._data[field][ticker_locs, date_locs] = df_daily[field].values.astype(CUBE_DTYPE)
+        self.flush()
+
+    def _grow(self, min_capacity: int) -> None:
+        """Resize files to the current tickers count and at least min_capacity days"""
+        capacity = self.capacity
+        if min_capacity > capacity:
+            capacity = max(min_capacity + MIN_DAYS_RESERVE, 2 * capacity)
+        shape = (len(self.tickers), capacity)
+
+        if capacity != self.capacity:
+            self._dates = _resize_npy(self._dates, (capacity,), np.datetime64('NaT', 'D'))
+        self._mask = _resize_npy(self._mask, shape, False)
+        for field in self.fields:
+            self._data[field] = _resize_npy(self._data[field], shape, np.nan)
+
+    def _save_meta(self) -> None:
+        save_json(os.path.join(self.base_path, _META_FILE), {
+            'tickers': self.tickers,
+            'fields': self.fields,
+            'days_cnt': self.days_cnt,
+        })
+
+
+def _resize_npy(arr: np.memmap, shape: tuple, fill_value) -> np.memmap:
+    """
+    Copy memmap to a bigger .npy file (with the same path) filled with fill_value.
+    The file is replaced, not truncated, so readers keep their maps of the old one.
+    """
+    path = arr.filename
+    tmp_path = path + '.tmp'
+    new_arr = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=arr.dtype, shape=shape)
+    new_arr[...] = fill_value
+    new_arr[tuple(slice(0, n) for n in arr.shape)] = arr
+    new_arr.flush()
+
+    del arr, new_arr
+    os.replace(tmp_path, path)
+    return np.load(path, mmap_mode='r+')
+
+
+def build_daily_cube(
+        df_daily: pd.DataFrame,
+        base_path: str,
+        fields: Optional[List[str]] = None,
+        days_reserve: int = MIN_DAYS_RESERVE,
+) -> DailyCube:
+    """
+    Build DailyCube from df_daily (result of quandl_daily_to_df)
+
+    :param days_reserve: Count of empty days preallocated to append new days in place
+    """
+    fields = fields or [f for f in CUBE_FIELDS if f in df_daily.columns]
+
+    # Build next to base_path and swap folders at the end, so files mapped by readers are never truncated
+    base_path = base_path.rstrip('/')
+    tmp_path = base_path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    tickers = sorted(df_daily['ticker'].unique())
+    dates = np.unique(_df_days(df_daily))
+    capacity = len(dates) + days_reserve
+    shape = (len(tickers), capacity)
+
+    dates_arr = np.lib.format.open_memmap(
+        os.path.join(tmp_path, _DATES_FILE), mode='w+', dtype='datetime64[D]', shape=(capacity,))
+    dates_arr[:] = np.datetime64('NaT', 'D')
+    dates_arr[:len(dates)] = dates
+    dates_arr.flush()
+
+    mask_arr = np.lib.format.open_memmap(
+        os.path.join(tmp_path, _MASK_FILE), mode='w+', dtype=bool, shape=shape)
+    mask_arr.flush()
+
+    for field in fields:
+        arr = np.lib.format.open_memmap(
+            os.path.join(tmp_path, _field_file(field)), mode='w+', dtype=CUBE_DTYPE, shape=shape)
+        arr[:] = np.nan
+        arr.flush()
+
+    del dates_arr, mask_arr
+
+    save_json(os.path.join(tmp_path, _META_FILE), {
+        'tickers': tickers,
+        'fields': fields,
+        'days_cnt': len(dates),
+    })
+
+    cube = DailyCube(tmp_path, mode='r+')
+    cube._write(df_daily, _df_days(df_daily))
+    del cube
+
+    # Directories can not be replaced over non-empty ones, so move the old cube away first.
+    # Removed files stay readable for processes which have them mapped.
+    old_path = base_path + '.old'
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(base_path):
+        os.replace(base_path, old_path)
+    os.replace(tmp_path, base_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+    return DailyCube(base_path)
@@ -3,6 +3,7 @@ import json
 import os
 import time
 from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.context import BaseContext
 from typing import List, Optional
 
 import numpy as np
@@ -110,6 +111,7 @@ def multiprocess_ticker_download(
         batch_size: int = 4,
         n_jobs: int = 4,
         skip_exists: bool = True,
+        mp_context: Optional[BaseContext] = None,
 ) -> None:
     os.makedirs(base_path, exist_ok=True)
 
@@ -120,14 +122,20 @@ def multiprocess_ticker_download(
             print(f'Skip {len(exist_tickers)} tickers')
         tickers_to_download = list(set(tickers).difference(set(exist_tickers)))
 
-    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
-        for chunk in chunks(tickers_to_download, batch_size):
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp_context) as executor:
+        futures = [
             executor.submit(
                 _batch_ticker_download,
                 path=path,
                 tickers=chunk,
                 base_path=base_path,
             )
+            for chunk in chunks(tickers_to_download, batch_size)
+        ]
+
+    # Raise exceptions from workers
+    for f in futures:
+        f.result()
 
 
 def download_commodities(base_path: str) -> None:
@@ -141,7 +149,7 @@ def download_commodities(base_path: str) -> None:
         r = requests.get(full_url)
         if r.status_code != 200:
             print(f'Error: {full_url}')
-            return
+            continue
 
         code_data = r.json()
         filepath = '{}/{}.json'.format(base_path, code.replace('/', '_'))
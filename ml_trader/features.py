@@ -1,3 +1,4 @@
+import hashlib
 from typing import Union, List, Dict, Any
 
 import numpy as np
@@ -35,6 +36,11 @@ COMMODITY_WINDOWS = DAILY_WINDOWS
 COMMODITY_COLUMNS = ["price"]
 
 
+def int_hash_of_str(text: str) -> int:
+    """Robust (unlike hash()) encoding of categorical values like sector"""
+    return int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8], 16)
+
+
 def calc_series_stats(series: Union[List[float], np.array]) -> Dict[str, float]:
     series = np.array(series).astype('float')
     series = series[~np.isnan(series)]
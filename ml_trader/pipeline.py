@@ -0,0 +1,653 @@
+"""
+Make-like pipeline: download -> ingest -> features -> train -> score.
+
+Stages are linked by files: a stage depends on the stages which produce its inputs.
+A stage is skipped when all its outputs exist and its last successful run is newer than its inputs.
+Independent stages run concurrently within the workers budget.
+
+Heavy libraries (pandas, xgboost, lightgbm) are imported inside stage functions only,
+so the CLI starts fast and skipped stages cost nothing.
+
+Usage (from a project subfolder, like load_config expects):
+    PYTHONPATH=.. python -m ml_trader.pipeline [stage ...] [-j WORKERS] [-f STAGE] [-n]
+"""
+import argparse
+import multiprocessing
+import os
+import pickle
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import date, timedelta
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from ml_trader.utils import BASE_DIR, load_config, check_create_folder
+
+DATASETS_PATH = os.path.join(BASE_DIR, 'datasets')
+CPU_COUNT = os.cpu_count() or 1
+
+DOWNLOAD_WORKERS = 4  # Parallel requests to Quandl
+MODELS_CNT = 20
+
+# Stages run in threads, and forking a multi-threaded process may deadlock,
+# so process pools inside stages start workers with spawn
+STAGE_MP_CONTEXT = 'spawn'
+
+
+class Stage:
+    """
+    Pipeline step. fn(n_jobs=...) must write all outputs.
+
+    :param workers: Share of the pipeline workers budget used by the stage (passed to fn as n_jobs)
+    :param max_age_days: Calendar days after which outputs are out of date even with unchanged inputs
+                         (downloads have no inputs, so they are refreshed by age).
+                         Calendar days, so a nightly run always refreshes outputs of the previous night.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            fn: Callable[..., None],
+            inputs: Sequence[str] = (),
+            outputs: Sequence[str] = (),
+            workers: int = 1,
+            max_age_days: Optional[int] = None,
+    ):
+        self.name = name
+        self.fn = fn
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.workers = workers
+        self.max_age_days = max_age_days
+
+
+def _path_mtime(path: str) -> Optional[float]:
+    """mtime of file or of the newest file in folder, None if there is nothing"""
+    if os.path.isfile(path):
+        return os.path.getmtime(path)
+    if not os.path.isdir(path):
+        return None
+
+    mtimes = [
+        os.path.getmtime(os.path.join(root, file_name))
+        for root, _, file_names in os.walk(path)
+        for file_name in file_names
+    ]
+    return max(mtimes) if mtimes else None
+
+
+def _stamp_path(stage: Stage) -> str:
+    """
+    File marking the last successful run of the stage (next to its first output).
+    Output mtimes can not be trusted: a failed download leaves new files in the folder
+    next to old ones, and files of tickers removed from config are never rewritten.
+    """
+    return os.path.join(os.path.dirname(stage.outputs[0]), f'.{stage.name}.done')
+
+
+def _write_stamp(stage: Stage, start_time: float) -> None:
+    # Stamp has the start time, so inputs changed while the stage was running make it stale
+    stamp_path = _stamp_path(stage)
+    check_create_folder(stamp_path)
+    with open(stamp_path, 'w'):
+        pass
+    os.utime(stamp_path, (start_time, start_time))
+
+
+def _remove_stamp(stage: Stage) -> None:
+    if stage.outputs and os.path.exists(_stamp_path(stage)):
+        os.remove(_stamp_path(stage))
+
+
+def is_up_to_date(stage: Stage) -> bool:
+    if not stage.outputs or None in map(_path_mtime, stage.outputs):
+        return False
+
+    stamp_path = _stamp_path(stage)
+    if not os.path.exists(stamp_path):
+        return False
+
+    done_time = os.path.getmtime(stamp_path)
+    if stage.max_age_days is not None:
+        if date.fromtimestamp(done_time) <= date.today() - timedelta(days=stage.max_age_days):
+            return False
+
+    inputs_mtimes = [m for m in map(_path_mtime, stage.inputs) if m is not None]
+    return not inputs_mtimes or max(inputs_mtimes) <= done_time
+
+
+def _stage_deps(stages: List[Stage]) -> Dict[str, List[str]]:
+    producers: Dict[str, str] = {}
+    for stage in stages:
+        for path in stage.outputs:
+            if path in producers:
+                raise ValueError(f'{path} is produced by both {producers[path]} and {stage.name}')
+            producers[path] = stage.name
+
+    return {
+        stage.name: sorted({producers[path] for path in stage.inputs if path in producers})
+        for stage in stages
+    }
+
+
+def _sorted_stages(deps: Dict[str, List[str]], targets: List[str]) -> List[str]:
+    """Targets with all their dependencies in topological order"""
+    order: List[str] = []
+    visiting = set()
+
+    def visit(name: str) -> None:
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError(f'Dependency cycle on {name}')
+        if name not in deps:
+            raise ValueError(f'Unknown stage {name}')
+
+        visiting.add(name)
+        for dep in deps[name]:
+            visit(dep)
+        visiting.remove(name)
+        order.append(name)
+
+    for target in targets:
+        visit(target)
+    return order
+
+
+def run_pipeline(
+        stages: List[Stage],
+        targets: Optional[List[str]] = None,
+        max_workers: int = CPU_COUNT,
+        force: Sequence[str] = (),
+        dry_run: bool = False,
+) -> Dict[str, str]:
+    """
+    Run out of date targets (all stages by default) and their dependencies.
+
+    :param force: Stages to run even if they are up to date
+    :return: Status of every stage: ran / skipped / failed / blocked (by failed dependency)
+             or stale (dry run only)
+    """
+    by_name = {stage.name: stage for stage in stages}
+    for name in force:
+        if name not in by_name:
+            raise ValueError(f'Unknown stage {name}')
+
+    deps = _stage_deps(stages)
+    order = _sorted_stages(deps, targets or list(by_name))
+
+    status: Dict[str, str] = {}
+    running: Dict[Future, str] = {}
+    start_times: Dict[str, float] = {}
+    used_workers = 0
+
+    with ThreadPoolExecutor(max_workers=len(order) or 1) as executor:
+        while len(status) < len(order):
+            for name in order:
+                if name in status or name in running.values():
+                    continue
+
+                deps_status = [status.get(dep) for dep in deps[name]]
+                if None in deps_status:
+                    continue
+                if 'failed' in deps_status or 'blocked' in deps_status:
+                    print(f'Blocked {name}')
+                    status[name] = 'blocked'
+                    continue
+
+                stage = by_name[name]
+                deps_stale = 'stale' in deps_status
+                if name not in force and not deps_stale and is_up_to_date(stage):
+                    print(f'Skip {name}, up to date')
+                    status[name] = 'skipped'
+                    continue
+                if dry_run:
+                    print(f'Stale {name}')
+                    status[name] = 'stale'
+                    continue
+
+                # One stage may take the whole budget, so it does not wait forever
+                n_jobs = max(1, min(stage.workers, max_workers))
+                if running and used_workers + n_jobs > max_workers:
+                    continue
+
+                print(f'Running {name} (n_jobs={n_jobs})')
+                # Stage is out of date until it succeeds, even if it fails halfway
+                _remove_stamp(stage)
+                start_times[name] = time.time()
+                used_workers += n_jobs
+                running[executor.submit(stage.fn, n_jobs=n_jobs)] = name
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                used_workers -= max(1, min(by_name[name].workers, max_workers))
+
+                exc = future.exception()
+                if exc is None:
+                    if by_name[name].outputs:
+                        _write_stamp(by_name[name], start_times[name])
+                    print(f'Done {name}')
+                    status[name] = 'ran'
+                else:
+                    print(f'Error: {name}')
+                    traceback.print_exception(type(exc), exc, exc.__traceback__)
+                    status[name] = 'failed'
+
+    failed = [name for name in order if status[name] == 'failed']
+    if failed:
+        raise RuntimeError(f'Failed stages: {failed}')
+
+    return status
+
+
+# ----
+# Stages
+# ----
+
+
+def _check_downloaded(paths: List[str], start_time: float) -> None:
+    """Loaders only print download errors, so check that every file is written by the stage"""
+    # 1 second slack for coarse file system timestamps
+    missing = [path for path in paths if not os.path.exists(path) or os.path.getmtime(path) < start_time - 1]
+    if missing:
+        raise RuntimeError(f'Not downloaded {len(missing)} files: {missing[:10]}')
+
+
+def _download_yahoo(n_jobs: int, ticker: str, datasets_path: str) -> None:
+    from ml_trader.data_loaders.yahoo import download_yahoo
+
+    start_time = time.time()
+    download_yahoo(ticker, base_path=datasets_path)
+    _check_downloaded([
+        f'{datasets_path}/yahoo/base/{ticker}.json',
+        f'{datasets_path}/yahoo/quarterly/{ticker}.csv',
+    ], start_time)
+
+
+def _download_tickers(n_jobs: int, save_path: str) -> None:
+    from ml_trader.data_loaders.quandl import download_base_zip
+
+    start_time = time.time()
+    download_base_zip('datatables/SHARADAR/TICKERS?qopts.export=true', save_path)
+    _check_downloaded([save_path], start_time)
+
+
+def _download_tickers_data(n_jobs: int, path: str, tickers: List[str], base_path: str) -> None:
+    from ml_trader.data_loaders.quandl import multiprocess_ticker_download
+
+    start_time = time.time()
+    # Stage runs only when data is out of date, so refresh all tickers
+    multiprocess_ticker_download(
+        path=path,
+        tickers=tickers,
+        base_path=base_path,
+        n_jobs=n_jobs,
+        skip_exists=False,
+        mp_context=multiprocessing.get_context(STAGE_MP_CONTEXT),
+    )
+    _check_downloaded([f'{base_path}/{ticker}.json' for ticker in tickers], start_time)
+
+
+def _download_commodities(n_jobs: int, base_path: str) -> None:
+    from ml_trader.data_loaders.quandl import QUANDL_COMMODITY_CODES, download_commodities
+
+    start_time = time.time()
+    download_commodities(base_path)
+    _check_downloaded(
+        ['{}/{}.json'.format(base_path, code.replace('/', '_')) for code in QUANDL_COMMODITY_CODES],
+        start_time,
+    )
+
+
+def _ingest_base(n_jobs: int, zip_path: str, tickers: List[str], save_path: str) -> None:
+    from ml_trader.data_loaders.quandl import quandl_base_to_df
+
+    # pandas reads csv from the single file zip directly
+    df = quandl_base_to_df(filepath=zip_path, tickers=tickers)
+    check_create_folder(save_path)
+    df.to_pickle(save_path)
+
+
+def _ingest_quarterly(n_jobs: int, base_path: str, tickers: List[str], save_path: str) -> None:
+    from ml_trader.data_loaders.quandl import quandl_quarterly_to_df
+
+    df = quandl_quarterly_to_df(base_path=base_path, tickers=tickers)
+    check_create_folder(save_path)
+    df.to_pickle(save_path)
+
+
+def _ingest_daily(n_jobs: int, base_path: str, tickers: List[str], save_path: str) -> None:
+    from ml_trader.data_loaders.quandl import quandl_daily_to_df
+
+    df = quandl_daily_to_df(base_path=base_path, tickers=tickers)
+    check_create_folder(save_path)
+    df.to_pickle(save_path)
+
+
+def _ingest_commodity(n_jobs: int, base_path: str, save_path: str) -> None:
+    from ml_trader.data_loaders.quandl import quandl_commodity_to_df
+
+    df = quandl_commodity_to_df(base_path=base_path)
+    check_create_folder(save_path)
+    df.to_pickle(save_path)
+
+
+def _build_cube(n_jobs: int, daily_path: str, save_path: str) -> None:
+    import numpy as np
+    import pandas as pd
+
+    from ml_trader.cube import DailyCube, build_daily_cube
+
+    df_daily = pd.read_pickle(daily_path)
+    if not os.path.isdir(save_path):
+        build_daily_cube(df_daily, save_path)
+        return
+
+    # Rewrite the last stored day (it may be partial) and append new days,
+    # new tickers come with their full history
+    cube = DailyCube(save_path, mode='r+')
+    new_rows = ~df_daily['ticker'].isin(cube.ticker_index)
+    if cube.days_cnt:
+        new_rows |= df_daily['date'] >= cube.dates[-1]
+    df_new = df_daily[new_rows]
+
+    # Days can only be appended after the last stored one, so history of a new ticker
+    # with days missing from the cube calendar needs a full rebuild
+    days = df_new['date'].values.astype('datetime64[D]')
+    missing_days = days[~np.isin(days, cube.dates)]
+    if cube.days_cnt and len(missing_days) and missing_days.min() < cube.dates[-1]:
+        print(f'Rebuild cube, {len(np.unique(missing_days))} days are missing in the calendar')
+        del cube
+        build_daily_cube(df_daily, save_path)
+        return
+
+    cube.append_days(df_new)
+
+
+def _ticker_features(
+        df_quarterly_ticker: Any,
+        cube: Any,
+        df_commodities: Dict[str, Any],
+        ticker: str,
+) -> Any:
+    import pandas as pd
+
+    from ml_trader.features import (DAILY_AGG_COLUMNS,
+                                    compute_df_quarterly_ticker,
+                                    compute_df_daily_ticker,
+                                    compute_df_commodity_ticker)
+
+    result = pd.DataFrame(compute_df_quarterly_ticker(df_quarterly_ticker, ticker))
+    if not len(result):
+        return result
+
+    # Cube is pickled as a path, so the worker maps daily data instead of receiving a copy
+    df_daily_ticker = cube.ticker_df(ticker, fields=DAILY_AGG_COLUMNS)
+    df_daily_p = pd.DataFrame(compute_df_daily_ticker(df_quarterly_ticker, df_daily_ticker, ticker))
+    if len(df_daily_p):
+        result = pd.merge(result, df_daily_p, on=['ticker', 'date'], how='left')
+
+    for code, df_commodity_ticker in df_commodities.items():
+        df_commodity_p = pd.DataFrame(
+            compute_df_commodity_ticker(df_quarterly_ticker, df_commodity_ticker, ticker))
+        if not len(df_commodity_p):
+            continue
+
+        # Feature names do not contain commodity code, so add it to avoid collisions
+        prefix = 'commodity_{}_'.format(code.replace('/', '_'))
+        df_commodity_p.columns = [
+            prefix + col[len('commodity_'):] if col.startswith('commodity_') else col
+            for col in df_commodity_p.columns
+        ]
+        result = pd.merge(result, df_commodity_p, on=['ticker', 'date'], how='left')
+
+    return result
+
+
+def _build_features(
+        n_jobs: int,
+        base_path: str,
+        quarterly_path: str,
+        cube_path: str,
+        commodity_path: str,
+        commodities: List[str],
+        save_path: str,
+) -> None:
+    from concurrent.futures import ProcessPoolExecutor
+
+    import pandas as pd
+
+    from ml_trader.cube import DailyCube
+    from ml_trader.features import int_hash_of_str
+
+    df_quarterly = pd.read_pickle(quarterly_path)
+    cube = DailyCube(cube_path)
+    df_commodity = pd.read_pickle(commodity_path)
+
+    df_commodities = {
+        code: df for code, df in df_commodity.groupby('commodity_code') if code in commodities
+    }
+
+    mp_context = multiprocessing.get_context(STAGE_MP_CONTEXT)
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp_context) as executor:
+        futures = [
+            executor.submit(
+                _ticker_features,
+                df_quarterly_ticker=df_quarterly_ticker,
+                cube=cube,
+                df_commodities=df_commodities,
+                ticker=ticker,
+            )
+            for ticker, df_quarterly_ticker in df_quarterly.groupby('ticker')
+        ]
+        X = pd.concat([f.result() for f in futures], axis=0)
+
+    df_base = pd.read_pickle(base_path)
+    df_base_p = df_base[['ticker', 'sector', 'sicindustry']].copy()
+    for col in ['sector', 'sicindustry']:
+        df_base_p[col] = [int_hash_of_str(str(x)) for x in df_base_p[col].fillna('None')]
+
+    X = pd.merge(X, df_base_p, on='ticker', how='left')
+    X = X.set_index(['ticker', 'date'])
+
+    check_create_folder(save_path)
+    X.to_pickle(save_path)
+
+
+def _marketcap_target(X: Any, df_quarterly: Any) -> Any:
+    y = df_quarterly.drop_duplicates(['ticker', 'date']).set_index(['ticker', 'date'])['marketcap']
+    return y.reindex(X.index)
+
+
+def _train(n_jobs: int, features_path: str, quarterly_path: str, models_cnt: int, save_path: str) -> None:
+    import lightgbm as lgbm
+    import pandas as pd
+    from xgboost import XGBRegressor
+
+    from ml_trader.model import LogExpModel, EnsembleModel
+
+    X = pd.read_pickle(features_path)
+    y = _marketcap_target(X, pd.read_pickle(quarterly_path))
+
+    base_models = [
+        LogExpModel(lgbm.sklearn.LGBMRegressor(n_jobs=n_jobs, n_estimators=200, num_leaves=2**4)),
+        LogExpModel(XGBRegressor(n_jobs=n_jobs, learning_rate=0.15, n_estimators=200)),
+    ]
+    ensemble = EnsembleModel(base_models=base_models, bagging_fraction=0.7, models_cnt=models_cnt)
+    ensemble.fit(X, y)
+
+    check_create_folder(save_path)
+    with open(save_path, 'wb') as f:
+        pickle.dump(ensemble, f)
+
+
+def _score(n_jobs: int, features_path: str, quarterly_path: str, model_path: str, save_path: str) -> None:
+    import pandas as pd
+
+    X = pd.read_pickle(features_path)
+    X = X.sort_index(level='date').groupby(level='ticker').tail(1)
+
+    with open(model_path, 'rb') as f:
+        model = pickle.load(f)
+
+    scores = pd.DataFrame(index=X.index)
+    scores['marketcap'] = _marketcap_target(X, pd.read_pickle(quarterly_path))
+    scores['pred_marketcap'] = model.predict(X)
+    scores['upside'] = scores['pred_marketcap'] / scores['marketcap'] - 1
+
+    check_create_folder(save_path)
+    scores.sort_values('upside', ascending=False).to_csv(save_path)
+
+
+def build_stages(datasets_path: str = DATASETS_PATH, config: Optional[Dict[str, Any]] = None) -> List[Stage]:
+    config = load_config() if config is None else config
+    tickers = config.get('tickers', [])
+    commodities = config.get('commodities', [])
+
+    quandl_path = os.path.join(datasets_path, 'quandl')
+    pipeline_path = os.path.join(datasets_path, 'pipeline')
+
+    tickers_zip = os.path.join(quandl_path, 'tickers.zip')
+    quarterly_json = os.path.join(quandl_path, 'quarterly')
+    daily_json = os.path.join(quandl_path, 'daily')
+    commodity_json = os.path.join(quandl_path, 'commodity')
+
+    base_df = os.path.join(pipeline_path, 'df_base.pkl')
+    quarterly_df = os.path.join(pipeline_path, 'df_quarterly.pkl')
+    daily_df = os.path.join(pipeline_path, 'df_daily.pkl')
+    commodity_df = os.path.join(pipeline_path, 'df_commodity.pkl')
+    cube = os.path.join(pipeline_path, 'cube')
+    features = os.path.join(pipeline_path, 'features.pkl')
+    model = os.path.join(pipeline_path, 'model.pkl')
+    scores = os.path.join(pipeline_path, 'scores.csv')
+
+    return [
+        # Download
+        #   we do not use Yahoo in the project, AAPL is an example
+        Stage(
+            'download_yahoo',
+            partial(_download_yahoo, ticker='AAPL', datasets_path=datasets_path),
+            outputs=[os.path.join(datasets_path, 'yahoo')],
+            max_age_days=1,
+        ),
+        Stage(
+            'download_tickers',
+            partial(_download_tickers, save_path=tickers_zip),
+            outputs=[tickers_zip],
+            max_age_days=7,
+        ),
+        Stage(
+            'download_quarterly',
+            partial(_download_tickers_data, path='datatables/SHARADAR/SF1?ticker={ticker}',
+                    tickers=tickers, base_path=quarterly_json),
+            outputs=[quarterly_json],
+            workers=DOWNLOAD_WORKERS,
+            max_age_days=7,
+        ),
+        Stage(
+            'download_daily',
+            partial(_download_tickers_data, path='datatables/SHARADAR/DAILY?ticker={ticker}',
+                    tickers=tickers, base_path=daily_json),
+            outputs=[daily_json],
+            workers=DOWNLOAD_WORKERS,
+            max_age_days=1,
+        ),
+        Stage(
+            'download_commodities',
+            partial(_download_commodities, base_path=commodity_json),
+            outputs=[commodity_json],
+            max_age_days=1,
+        ),
+        # Ingest
+        Stage(
+            'ingest_base',
+            partial(_ingest_base, zip_path=tickers_zip, tickers=tickers, save_path=base_df),
+            inputs=[tickers_zip],
+            outputs=[base_df],
+        ),
+        Stage(
+            'ingest_quarterly',
+            partial(_ingest_quarterly, base_path=quarterly_json, tickers=tickers, save_path=quarterly_df),
+            inputs=[quarterly_json],
+            outputs=[quarterly_df],
+        ),
+        Stage(
+            'ingest_daily',
+            partial(_ingest_daily, base_path=daily_json, tickers=tickers, save_path=daily_df),
+            inputs=[daily_json],
+            outputs=[daily_df],
+        ),
+        Stage(
+            'ingest_commodity',
+            partial(_ingest_commodity, base_path=commodity_json, save_path=commodity_df),
+            inputs=[commodity_json],
+            outputs=[commodity_df],
+        ),
+        Stage(
+            'build_cube',
+            partial(_build_cube, daily_path=daily_df, save_path=cube),
+            inputs=[daily_df],
+            outputs=[cube],
+        ),
+        # Features
+        Stage(
+            'features',
+            partial(_build_features, base_path=base_df, quarterly_path=quarterly_df, cube_path=cube,
+                    commodity_path=commodity_df, commodities=commodities, save_path=features),
+            inputs=[base_df, quarterly_df, cube, commodity_df],
+            outputs=[features],
+            workers=CPU_COUNT,
+        ),
+        # Train & score
+        Stage(
+            'train',
+            partial(_train, features_path=features, quarterly_path=quarterly_df,
+                    models_cnt=MODELS_CNT, save_path=model),
+            inputs=[features, quarterly_df],
+            outputs=[model],
+            workers=CPU_COUNT,
+        ),
+        Stage(
+            'score',
+            partial(_score, features_path=features, quarterly_path=quarterly_df,
+                    model_path=model, save_path=scores),
+            inputs=[features, quarterly_df, model],
+            outputs=[scores],
+        ),
+    ]
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='Run out of date pipeline stages')
+    parser.add_argument('targets', nargs='*', help='Stages to run with dependencies (all by default)')
+    parser.add_argument('-j', '--workers', type=int, default=CPU_COUNT, help='Workers budget')
+    parser.add_argument('-f', '--force', action='append', default=[], help='Run stage even if up to date')
+    parser.add_argument('-B', '--force-all', action='store_true', help='Run all stages even if up to date')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='Only print stale stages')
+    parser.add_argument('-l', '--list', action='store_true', help='Print stages with dependencies')
+    parser.add_argument('--datasets-path', default=DATASETS_PATH)
+    args = parser.parse_args(argv)
+
+    stages = build_stages(args.datasets_path)
+    if args.list:
+        for name, deps in _stage_deps(stages).items():
+            print(f'{name}: {" ".join(deps)}')
+        return
+
+    force = [stage.name for stage in stages] if args.force_all else args.force
+    run_pipeline(
+        stages,
+        targets=args.targets,
+        max_workers=args.workers,
+        force=force,
+        dry_run=args.dry_run,
+    )
+
+
+if __name__ == '__main__':
+    main()